@@ -1,14 +1,25 @@
 import argparse
+import atexit
+import importlib.util
 import os
 import mimetypes
 import time
 import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
 from functools import lru_cache
 from pathlib import Path
+from urllib.parse import quote
 import threading
 import logging
 import shutil
+import re
+import socket
+import sqlite3
+import stat
+import sys
+import ctypes
+import struct
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -29,16 +40,78 @@ mimetypes.add_type("video/x-msvideo", ".avi")
 mimetypes.add_type("video/webm", ".webm")
 mimetypes.add_type("video/mpeg", ".mpeg")
 mimetypes.add_type("video/mpeg", ".mpg")
+# 较新的图片格式，旧版本 Python 的 mimetypes 表里可能没有
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("image/heic", ".heic")
+mimetypes.add_type("image/jpeg", ".jfif")
+
+# 浏览器原生支持的格式（/files 直接提供，不重定向到转码）
+NATIVELY_SUPPORTED = frozenset({'.mp4', '.webm', '.ogg', '.ogv', '.m4v', '.mpg', '.mpeg', '.avi', '.mov', '.wmv'})
+# 播放页面可直接播放的格式（注：AVI虽然有些浏览器支持，但兼容性差，建议转码）
+BROWSER_PLAYABLE_EXTS = frozenset({'.mp4', '.webm', '.ogg', '.ogv', '.m4v'})
+# 某些硬件解码器对 JPEG 支持不好
+_JPEG_EXTS = frozenset({'.jpg', '.jpeg', '.jpe'})
+
+# 视频/音频/图片/文本扩展名的 MIME 类型表（包含上面追加的类型），导入时预先生成
+MIME_FAST = {ext: mime for ext, mime in mimetypes.types_map.items()
+             if mime.startswith(('video/', 'audio/', 'image/', 'text/'))}
+
+# 图库模式识别的图片扩展名，与 MIME 表同源，保证列表筛选和查看页的判断一致
+_IMAGE_EXTS = frozenset(ext for ext, mime in MIME_FAST.items() if mime.startswith('image/'))
+
+def _mime_for_ext(ext):
+    """按扩展名（小写，带点）查询 MIME 类型，常用类型直接查表"""
+    return MIME_FAST.get(ext) or _guess_mime_for_ext(ext)
+
+@lru_cache(maxsize=256)
+def _guess_mime_for_ext(ext):
+    """查表未命中时回退到 mimetypes（结果只取决于扩展名，缓存）"""
+    return mimetypes.guess_type('x' + ext)[0]
+
+# 媒体信息已改用 ffprobe 读取，这里只检查 DeFFcode 是否安装，不导入
+DEFFCODE_AVAILABLE = importlib.util.find_spec("deffcode") is not None
+if DEFFCODE_AVAILABLE:
+    logger.info("DeFFcode 库已安装，支持硬件加速解码")
+else:
+    logger.warning("DeFFcode 库未安装，将使用传统解码方式")
 
 try:
-    from deffcode import FFdecoder
-    DEFFCODE_AVAILABLE = True
-    logger.info("DeFFcode 库已成功导入，支持硬件加速解码")
+    import charset_normalizer
+    CHARSET_NORMALIZER_AVAILABLE = True
 except ImportError:
-    DEFFCODE_AVAILABLE = False
-    logger.warning("DeFFcode 库未安装，将使用传统解码方式")
+    CHARSET_NORMALIZER_AVAILABLE = False
+    logger.info("charset_normalizer 库未安装，文本编码将逐个尝试检测")
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import anyio
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+    from starlette.applications import Starlette
+    from starlette.responses import FileResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+    from starlette.responses import Response as StarletteResponse
+    from starlette.routing import Mount, Route
+    ASGI_AVAILABLE = True
+except ImportError:
+    ASGI_AVAILABLE = False
 
-from flask import Flask, request, send_file, abort, Response, render_template, redirect, url_for, jsonify
+try:
+    import waitress
+    WAITRESS_AVAILABLE = True
+except ImportError:
+    WAITRESS_AVAILABLE = False
+
+from cachetools import LRUCache, TTLCache
+from flask import Flask, request, send_file, abort, Response, render_template, redirect, url_for
+from markupsafe import escape
+from werkzeug.http import is_resource_modified, quote_etag, http_date
+from werkzeug.serving import WSGIRequestHandler
 
 app = Flask(__name__, template_folder="templates")
 
@@ -47,6 +120,7 @@ app.config['MAX_THUMBNAIL_SIZE'] = (320, 240)  # 缩略图尺寸
 app.config['IMAGE_CACHE_DIR'] = '.webcinema_cache'
 app.config['USE_HARDWARE_ACCEL'] = True  # 是否使用硬件加速
 app.config['GPU_DEVICE'] = 0  # GPU设备索引
+app.config['MAX_CONCURRENT_TRANSCODES'] = 2  # 同时转码的最大数量
 
 # 自定义 Jinja2 过滤器：将整数时间戳格式化为可读日期时间
 def datetime_filter(timestamp):
@@ -58,8 +132,17 @@ def datetime_filter(timestamp):
 
 app.jinja_env.filters['datetime'] = datetime_filter
 
+def ojson(obj, status=200):
+    """返回 JSON 响应（已安装 orjson 时用它编码，否则使用标准库 json）"""
+    if ORJSON_AVAILABLE:
+        body = orjson.dumps(obj)
+    else:
+        body = json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    return Response(body, status=status, mimetype='application/json')
+
+@lru_cache(maxsize=1)
 def get_ffmpeg_path():
-    """返回 FFmpeg 可执行文件的路径，优先使用项目内捆绑的版本"""
+    """返回 FFmpeg 可执行文件的路径，优先使用项目内捆绑的版本（结果在进程内缓存）"""
     import sys
     import os
     import platform
@@ -105,25 +188,48 @@ def get_ffmpeg_path():
     # 未找到任何可用的 ffmpeg
     return None
 
+@lru_cache(maxsize=1)
+def get_ffprobe_path():
+    """返回 FFprobe 可执行文件的路径，优先使用与 FFmpeg 同目录的版本"""
+    import platform
+
+    ffmpeg_path = get_ffmpeg_path()
+    if not ffmpeg_path:
+        return None
+
+    exe_name = 'ffprobe.exe' if platform.system() == 'Windows' else 'ffprobe'
+    if ffmpeg_path != 'ffmpeg':
+        # 捆绑的 FFmpeg 旁边通常也带有 ffprobe
+        bundled_path = os.path.join(os.path.dirname(ffmpeg_path), exe_name)
+        if os.path.isfile(bundled_path) and os.access(bundled_path, os.X_OK):
+            return bundled_path
+
+    # 系统 PATH 中的 ffprobe
+    if shutil.which('ffprobe'):
+        return 'ffprobe'
+    return None
+
+# 自然排序用的数字切分（预编译，避免每次调用重新解析正则）
+_NAT_SPLIT = re.compile(r'(\d+)').split
+
+@lru_cache(maxsize=4096)
 def natural_sort_key(filename):
     """
     用于自然排序的函数。
     将文件名分解为文本和数字部分，数字部分转换为整数以便正确排序。
     例如: "航 (1).jpg" < "航 (2).jpg" < "航 (10).jpg" < "航 (100).jpg"
+    结果按文件名缓存，目录重复列出和图库浏览会反复使用同一批文件名。
     """
-    import re
-    # 将文件名分解为文本和数字混合的列表
-    # 例如 "航 (123).jpg" -> ['航 (', 123, ').jpg']
-    parts = []
-    for part in re.split(r'(\d+)', str(filename).lower()):
-        if part.isdigit():
-            parts.append((0, int(part)))  # 数字排在前面
-        else:
-            parts.append((1, part))  # 文本排在后面
-    return parts
+    # 例如 "航 (123).jpg" -> ((1, '航 ('), (0, 123), (1, ').jpg'))，数字排在文本前面
+    return tuple([(0, int(p)) if p.isdigit() else (1, p) for p in _NAT_SPLIT(str(filename).lower())])
 
+# ffmpeg -encoders 输出中的 GPU 编码器名称，及其对应的硬件加速方式
+_ENC_RE = re.compile(r'\b(h264|hevc|av1)_(nvenc|qsv|amf)\b')
+_ENCODER_HWACCEL = {'nvenc': 'cuda', 'qsv': 'qsv', 'amf': 'amf'}
+
+@lru_cache(maxsize=1)
 def detect_hardware_acceleration():
-    """检测可用的硬件加速器与 GPU 编码器"""
+    """检测可用的硬件加速器与 GPU 编码器（只在首次调用时探测，之后返回缓存结果）"""
     import subprocess
     
     ffmpeg_path = get_ffmpeg_path()
@@ -143,10 +249,20 @@ def detect_hardware_acceleration():
     verified_encoders = []
     gpu_type = None  # 检测到的GPU类型：intel, amd, nvidia
     
+    def run_ffmpeg(option):
+        return subprocess.run([ffmpeg_path, '-hide_banner', option],
+                              capture_output=True, text=True, timeout=5)
+
     try:
+        # 两次查询同时启动，重叠 FFmpeg 的进程启动开销
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            hwaccels_future = executor.submit(run_ffmpeg, '-hwaccels')
+            encoders_future = executor.submit(run_ffmpeg, '-encoders')
+            hwaccels_result = hwaccels_future.result()
+            encoders_result = encoders_future.result()
+
         # 检测硬件加速方法
-        result = subprocess.run([ffmpeg_path, '-hwaccels'],
-                                capture_output=True, text=True, timeout=5)
+        result = hwaccels_result
         if result.returncode == 0:
             lines = result.stdout.split('\n')
             in_hwaccel_section = False
@@ -159,38 +275,14 @@ def detect_hardware_acceleration():
                     hwaccels.append(line)
         
         # 检测可用的 GPU 编码器
-        result = subprocess.run([ffmpeg_path, '-encoders'],
-                                capture_output=True, text=True, timeout=5)
+        result = encoders_result
         if result.returncode == 0:
-            lines = result.stdout.split('\n')
-            encoder_list = {}
-            has_nvidia = False
-            has_amd = False
-            has_intel = False
-            
-            for line in lines:
-                # 格式: " V....D h264_nvenc      NVIDIA NVENC H.264 encoder..."
-                if 'h264_nvenc' in line:
-                    encoder_list['h264_nvenc'] = 'cuda'
-                    has_nvidia = True
-                elif 'hevc_nvenc' in line:
-                    encoder_list['hevc_nvenc'] = 'cuda'
-                    has_nvidia = True
-                elif 'av1_nvenc' in line:
-                    encoder_list['av1_nvenc'] = 'cuda'
-                    has_nvidia = True
-                elif 'h264_qsv' in line:
-                    encoder_list['h264_qsv'] = 'qsv'
-                    has_intel = True
-                elif 'hevc_qsv' in line:
-                    encoder_list['hevc_qsv'] = 'qsv'
-                    has_intel = True
-                elif 'h264_amf' in line:
-                    encoder_list['h264_amf'] = 'amf'
-                    has_amd = True
-                elif 'hevc_amf' in line:
-                    encoder_list['hevc_amf'] = 'amf'
-                    has_amd = True
+            # 格式: " V....D h264_nvenc      NVIDIA NVENC H.264 encoder..."
+            encoder_list = {f"{codec}_{hw}": _ENCODER_HWACCEL[hw] for codec, hw in _ENC_RE.findall(result.stdout)}
+            found_hw = set(encoder_list.values())
+            has_nvidia = 'cuda' in found_hw
+            has_amd = 'amf' in found_hw
+            has_intel = 'qsv' in found_hw
             
             # 确定GPU类型（优先级：Intel QSV > AMD AMF > NVIDIA NVENC）
             if has_intel:
@@ -242,6 +334,7 @@ def detect_hardware_acceleration():
     }
 
 
+@lru_cache(maxsize=16)
 def _verify_encoder(encoder_name, hwaccel):
     """通过快速测试验证硬件编码器是否真的可用"""
     import subprocess
@@ -315,26 +408,126 @@ FFMPEG_INSTALL_GUIDE = '''
 - AMF: 需要 AMD 驱动和支持的 FFmpeg 构建。
 '''
 
+# 转码输出每次转发给客户端的最大字节数
+TRANSCODE_CHUNK_SIZE = 1024 * 1024
+
+# 同时运行的转码进程上限（消费级显卡通常只有 2~3 个 NVENC 会话）
+TRANSCODE_SEM = threading.BoundedSemaphore(app.config['MAX_CONCURRENT_TRANSCODES'])
+# 等待转码名额的最长时间（秒），超时返回 503
+TRANSCODE_QUEUE_TIMEOUT = 30
+
 # 创建缓存目录
 os.makedirs(app.config['IMAGE_CACHE_DIR'], exist_ok=True)
 
 def safe_path(root, relpath):
-    """安全路径检查"""
-    full = os.path.realpath(os.path.join(root, relpath))
-    root_real = os.path.realpath(root)
-    if os.path.commonprefix([full, root_real]) != root_real:
+    """安全路径检查（按字面规范化路径，不逐级解析符号链接）"""
+    root_norm = os.path.normpath(root)
+    full = os.path.normpath(os.path.join(root_norm, relpath))
+    # 必须是根目录本身或位于根目录之下（带分隔符比较，避免 /media 匹配 /media2）
+    prefix = root_norm if root_norm.endswith(os.sep) else root_norm + os.sep
+    if full != root_norm and not full.startswith(prefix):
         return None
     return full
 
+def _stat_or_404(path):
+    """stat 一次文件，路径无效或不存在时返回 404（代替 exists 检查 + 再次 stat）"""
+    if path is None:
+        abort(404)
+    try:
+        return os.stat(path)
+    except OSError:
+        abort(404)
+
+def _stat_regular_file(path):
+    """stat 一次文件，不存在或不是普通文件时返回 None（ASGI 路由在线程池中调用）"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+def _file_validators(st):
+    """由 stat 结果生成 (ETag, Last-Modified)，Flask 和 ASGI 的文件路由共用，保证验证器一致"""
+    etag = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), tz=timezone.utc)
+    return etag, last_modified
+
+_CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+def _is_not_modified(headers, etag, last_modified):
+    """按条件请求头判断客户端缓存是否仍有效（headers 可以是 Flask 或 Starlette 的请求头）"""
+    environ = {}
+    for name in _CONDITIONAL_HEADERS:
+        value = headers.get(name)
+        if value:
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return not is_resource_modified(environ, etag=etag, last_modified=last_modified)
+
+def _not_modified_headers(etag, last_modified):
+    """304 响应携带的验证器"""
+    return {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+    }
+
+# Linux 上网络文件系统（NFS/SMB 等）的文件属性快速读取：
+# statx 只请求大小和修改时间，并允许使用客户端缓存的属性（AT_STATX_DONT_SYNC），减少网络往返
+_NETWORK_FS_TYPES = frozenset({'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph', '9p', 'fuse.sshfs', 'fuse.rclone'})
+_AT_FDCWD = -100
+_AT_STATX_DONT_SYNC = 0x4000
+_STATX_MTIME = 0x40
+_STATX_SIZE = 0x200
+
+def _load_statx():
+    """加载 libc 中的 statx（仅 Linux，glibc 2.28+）"""
+    if sys.platform != 'linux':
+        return None
+    try:
+        statx = ctypes.CDLL(None, use_errno=True).statx
+    except (OSError, AttributeError):
+        return None
+    statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_void_p]
+    statx.restype = ctypes.c_int
+    return statx
+
+_STATX = _load_statx()
+
+def _statx_size_mtime(path):
+    """用 statx 读取文件大小和修改时间"""
+    buf = ctypes.create_string_buffer(256)  # struct statx
+    if _STATX(_AT_FDCWD, os.fsencode(path), _AT_STATX_DONT_SYNC, _STATX_SIZE | _STATX_MTIME, buf) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    size, = struct.unpack_from('=Q', buf, 40)  # stx_size
+    sec, nsec = struct.unpack_from('=qI', buf, 112)  # stx_mtime
+    return size, sec + nsec / 1e9
+
+@lru_cache(maxsize=256)
+def _is_network_fs(path):
+    """判断路径是否位于网络文件系统上（按 /proc/self/mounts 中最长的挂载点匹配）"""
+    best_mount, best_type = '', ''
+    try:
+        with open('/proc/self/mounts', 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                prefix = mount_point if mount_point.endswith('/') else mount_point + '/'
+                if (path == mount_point or path.startswith(prefix)) and len(mount_point) > len(best_mount):
+                    best_mount, best_type = mount_point, fields[2]
+    except OSError:
+        return False
+    return best_type in _NETWORK_FS_TYPES
+
 def _get_directory_cache_key_raw(root, relpath):
     """生成目录缓存键"""
     full = safe_path(root, relpath)
-    if not full or not os.path.exists(full):
+    if not full:
         return None
     try:
-        stat = os.stat(full)
-        return f"{full}:{stat.st_mtime}"
-    except:
+        return f"{full}:{os.stat(full).st_mtime_ns}"
+    except OSError:
         return None
 
 def _list_dir_entries_cached_raw(root, relpath, cache_key):
@@ -344,19 +537,30 @@ def _list_dir_entries_cached_raw(root, relpath, cache_key):
         return []
     
     entries = []
+    append = entries.append
+    # 子路径前缀只需计算一次
+    prefix = relpath.replace("\\", "/").rstrip("/") + "/" if relpath else ""
+    # 网络文件系统上改用 statx 读取文件属性
+    use_statx = _STATX is not None and _is_network_fs(full)
     try:
         with os.scandir(full) as it:
             for entry in it:
                 try:
-                    rel_path = os.path.join(relpath, entry.name).replace("\\", "/")
-                    entries.append({
+                    is_dir = entry.is_dir()
+                    if use_statx and not is_dir:
+                        size, mtime = _statx_size_mtime(entry.path)
+                    else:
+                        # 每个条目只取一次 stat 结果，大小和修改时间都从中读取
+                        st = entry.stat()
+                        size, mtime = (0 if is_dir else st.st_size), st.st_mtime
+                    append({
                         "name": entry.name,
-                        "relpath": rel_path,
-                        "is_dir": entry.is_dir(),
-                        "size": entry.stat().st_size if not entry.is_dir() else 0,
-                        "modified": entry.stat().st_mtime
+                        "relpath": prefix + entry.name,
+                        "is_dir": is_dir,
+                        "size": size,
+                        "modified": mtime
                     })
-                except PermissionError:
+                except (PermissionError, FileNotFoundError):
                     continue
     except PermissionError:
         return []
@@ -369,8 +573,46 @@ def _list_dir_entries_cached_raw(root, relpath, cache_key):
     
     return entries
 
-get_directory_cache_key = lru_cache(maxsize=256)(_get_directory_cache_key_raw)
-list_dir_entries_cached = lru_cache(maxsize=256)(_list_dir_entries_cached_raw)
+def _dir_entries_size(entries):
+    """估算一个目录列表占用的内存（字节），用于按内存大小淘汰缓存"""
+    return sum(len(e['name']) + len(e['relpath']) for e in entries) + 128 * len(entries) + 128
+
+# 目录列表缓存按估算的内存占用淘汰，而不是按目录数量
+DIR_CACHE_MAX_BYTES = 64_000_000
+_DIR_CACHE = LRUCache(maxsize=DIR_CACHE_MAX_BYTES, getsizeof=_dir_entries_size)
+_DIR_CACHE_LOCK = threading.Lock()
+
+def list_dir_entries_cached(root, relpath, cache_key):
+    """带缓存的目录列表（缓存键变化即视为目录已修改）"""
+    key = (root, relpath, cache_key)
+    with _DIR_CACHE_LOCK:
+        entries = _DIR_CACHE.get(key)
+    if entries is None:
+        entries = _list_dir_entries_cached_raw(root, relpath, cache_key)
+        with _DIR_CACHE_LOCK:
+            try:
+                _DIR_CACHE[key] = entries
+            except ValueError:
+                # 单个目录列表超过整个缓存上限，不缓存
+                pass
+    return entries
+
+# 目录缓存键（路径 + mtime_ns）只短暂缓存，过期后重新 stat，目录增删文件能自动生效
+DIR_KEY_TTL = 5
+_DIR_KEY_CACHE = TTLCache(maxsize=256, ttl=DIR_KEY_TTL)
+_DIR_KEY_LOCK = threading.Lock()
+_MISSING = object()
+
+def get_directory_cache_key(root, relpath):
+    """获取目录缓存键（TTL 缓存，避免每次请求都 stat 目录）"""
+    key = (root, relpath)
+    with _DIR_KEY_LOCK:
+        cache_key = _DIR_KEY_CACHE.get(key, _MISSING)
+    if cache_key is _MISSING:
+        cache_key = _get_directory_cache_key_raw(root, relpath)
+        with _DIR_KEY_LOCK:
+            _DIR_KEY_CACHE[key] = cache_key
+    return cache_key
 
 def list_dir_entries(root, relpath=""):
     """获取目录条目（带智能缓存）"""
@@ -380,127 +622,179 @@ def list_dir_entries(root, relpath=""):
     
     return list_dir_entries_cached(root, relpath, cache_key)
 
+def _list_image_files_cached_raw(root, relpath, cache_key):
+    """筛选目录中的图片，返回排序后的路径列表和 {路径: 索引} 映射"""
+    # 目录条目已经由 list_dir_entries 校验过并按自然排序，只需按扩展名筛选
+    image_files = tuple(entry['relpath'] for entry in list_dir_entries_cached(root, relpath, cache_key)
+                        if not entry['is_dir'] and os.path.splitext(entry['name'])[1].lower() in _IMAGE_EXTS)
+    image_index = {path: i for i, path in enumerate(image_files)}
+    return image_files, image_index
+
+list_image_files_cached = lru_cache(maxsize=128)(_list_image_files_cached_raw)
+
+def list_image_files(root, relpath=""):
+    """获取目录中的图片列表（随目录缓存键一起失效）"""
+    cache_key = get_directory_cache_key(root, relpath)
+    if cache_key is None:
+        return (), {}
+    
+    return list_image_files_cached(root, relpath, cache_key)
+
 def get_media_info(file_path):
-    """获取媒体文件信息（使用DeFFcode）"""
-    if not DEFFCODE_AVAILABLE or not os.path.exists(file_path):
+    """获取媒体文件信息（使用 ffprobe 读取容器头信息）"""
+    if not get_ffprobe_path():
         return {}
-    
     try:
-        decoder_config = {
-            "source": file_path,
-            "verbose": False,
-            "frame_format": "rgb24"  # 使用有效的像素格式而不是 'null'
-        }
-        
-        with FFdecoder(**decoder_config) as decoder:
-            info = decoder.metadata
-            # 如果 info 是字符串，尝试解析为 JSON
-            if isinstance(info, str):
-                try:
-                    import json
-                    info = json.loads(info)
-                except json.JSONDecodeError:
-                    logger.warning(f"metadata 是字符串但非 JSON: {info[:100]}")
-                    return {}
-            # 确保 info 是字典
-            if not isinstance(info, dict):
-                logger.warning(f"metadata 不是字典，而是 {type(info)}: {info}")
-                return {}
-            # 从解析后的 metadata 提取字段
-            duration = info.get('source_duration_sec', 0)
-            resolution = info.get('source_video_resolution', [0, 0])
-            width = resolution[0] if isinstance(resolution, list) and len(resolution) >= 2 else 0
-            height = resolution[1] if isinstance(resolution, list) and len(resolution) >= 2 else 0
-            fps = info.get('source_video_framerate', 0)
-            codec = info.get('source_video_decoder', '未知')
-            bitrate_str = info.get('source_video_bitrate', '0')
-            format_ = info.get('source_extension', '未知')
-            
-            # 解析比特率字符串（如 "727k" -> 727000）
-            bitrate = 0
-            if bitrate_str:
-                try:
-                    # 移除空格，处理后缀 k/M
-                    bitrate_str = bitrate_str.strip().lower()
-                    multiplier = 1
-                    if bitrate_str.endswith('k'):
-                        multiplier = 1000
-                        bitrate_str = bitrate_str[:-1]
-                    elif bitrate_str.endswith('m'):
-                        multiplier = 1000000
-                        bitrate_str = bitrate_str[:-1]
-                    # 转换为浮点数后乘以倍数
-                    bitrate = int(float(bitrate_str) * multiplier)
-                except (ValueError, TypeError):
-                    bitrate = 0
-            
-            # 格式化时长
-            if duration:
-                hours = int(duration // 3600)
-                minutes = int((duration % 3600) // 60)
-                seconds = int(duration % 60)
-                duration_str = f"{hours:02d}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
-            else:
-                duration_str = "未知"
-            
-            return {
-                'duration': duration,
-                'duration_str': duration_str,
-                'width': width,
-                'height': height,
-                'fps': fps,
-                'codec': codec,
-                'bitrate': bitrate,
-                'format': format_
-            }
+        mtime = os.stat(file_path).st_mtime
+        # 返回副本，避免调用方修改缓存中的结果
+        return dict(_probe_media_info(file_path, mtime))
     except Exception as e:
         logger.error(f"获取媒体信息失败: {e}")
         return {}
 
+def _parse_frame_rate(rate):
+    """解析 ffprobe 的帧率字符串（如 "24000/1001"）"""
+    num, _, den = (rate or '0').partition('/')
+    try:
+        num = float(num)
+        den = float(den) if den else 1.0
+    except ValueError:
+        return 0
+    return round(num / den, 3) if den else 0
+
+@lru_cache(maxsize=512)
+def _probe_media_info(file_path, mtime):
+    """调用 ffprobe 获取媒体信息（按路径和修改时间缓存；失败时抛出异常，失败结果不进入缓存）"""
+    import subprocess
+
+    result = subprocess.run([get_ffprobe_path(), '-v', 'error', '-show_streams', '-show_format', '-of', 'json', file_path],
+                            capture_output=True, timeout=5)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe 读取失败: {result.stderr[:200].decode(errors='replace')}")
+    info = json.loads(result.stdout)
+    fmt = info.get('format', {})
+    streams = info.get('streams', [])
+    video = next((st for st in streams if st.get('codec_type') == 'video'), {})
+    audio = next((st for st in streams if st.get('codec_type') == 'audio'), {})
+
+    duration = float(fmt.get('duration') or 0)
+    width = int(video.get('width') or 0)
+    height = int(video.get('height') or 0)
+    fps = _parse_frame_rate(video.get('avg_frame_rate') or video.get('r_frame_rate'))
+    codec = video.get('codec_name') or audio.get('codec_name') or '未知'
+    bitrate = int(fmt.get('bit_rate') or 0)
+    format_ = os.path.splitext(file_path)[1].lower() or '未知'
+    
+    # 格式化时长
+    if duration:
+        hours = int(duration // 3600)
+        minutes = int((duration % 3600) // 60)
+        seconds = int(duration % 60)
+        duration_str = f"{hours:02d}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+    else:
+        duration_str = "未知"
+    
+    return {
+        'duration': duration,
+        'duration_str': duration_str,
+        'width': width,
+        'height': height,
+        'fps': fps,
+        'codec': codec,
+        'bitrate': bitrate,
+        'format': format_
+    }
+
 def compute_file_hash(file_path):
-    """计算文件的 SHA256 哈希值"""
+    """根据文件路径、大小和修改时间计算文件指纹（无需读取文件内容）"""
     import hashlib
-    sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        # 分块读取以避免大文件内存问题
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+    st = os.stat(file_path)
+    return hashlib.sha1(f"{os.path.realpath(file_path)}|{st.st_size}|{int(st.st_mtime)}".encode()).hexdigest()
 
-def get_reading_progress(file_hash):
-    """从缓存中读取阅读进度"""
-    import json
-    progress_file = os.path.join(app.config['IMAGE_CACHE_DIR'], 'reading_progress.json')
-    if os.path.exists(progress_file):
+# 阅读进度保存在 SQLite（WAL 模式）中，每次读写只需一条语句
+_PROGRESS_LOCK = threading.Lock()
+
+def _connect_progress_db(db_path):
+    """连接进度数据库并建表"""
+    db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    try:
+        db.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 只在检查点时同步磁盘：每次保存进度不再 fsync，断电最多丢失最近几次更新，数据库不会损坏
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS progress(hash TEXT PRIMARY KEY, position INT, percentage REAL, ts REAL)')
+    except sqlite3.Error:
+        db.close()
+        raise
+    return db
+
+def _open_progress_db():
+    """打开阅读进度数据库，并导入旧版 JSON 进度文件"""
+    cache_dir = app.config['IMAGE_CACHE_DIR']
+    db_path = os.path.join(cache_dir, 'progress.db')
+    try:
+        db = _connect_progress_db(db_path)
+    except sqlite3.Error as e:
+        # 数据库损坏时移到一旁重新创建（只丢失阅读进度），不影响服务器启动
+        logger.warning(f"阅读进度数据库无法打开，将重新创建: {e}")
         try:
-            with open(progress_file, 'r', encoding='utf-8') as f:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.replace(db_path + suffix, db_path + suffix + '.corrupt')
+            db = _connect_progress_db(db_path)
+        except (OSError, sqlite3.Error) as e:
+            # 仍然失败时使用内存数据库，本次运行期间的进度不会保存到磁盘
+            logger.warning(f"无法重新创建阅读进度数据库，进度将不会保存: {e}")
+            db = _connect_progress_db(':memory:')
+
+    legacy_file = os.path.join(cache_dir, 'reading_progress.json')
+    if os.path.exists(legacy_file):
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-                return data.get(file_hash)
-        except (json.JSONDecodeError, IOError):
-            pass
-    return None
+            rows = [(key, value.get('position'), value.get('percentage'), value.get('timestamp'))
+                    for key, value in data.items() if isinstance(value, dict)]
+            with db:
+                db.executemany('INSERT OR IGNORE INTO progress VALUES (?, ?, ?, ?)', rows)
+            os.replace(legacy_file, legacy_file + '.bak')
+            logger.info(f"已导入旧版阅读进度 {len(rows)} 条")
+        except (json.JSONDecodeError, IOError, AttributeError, sqlite3.Error) as e:
+            logger.warning(f"无法导入旧版进度文件 {legacy_file}: {e}")
+    return db
+
+_PROGRESS_DB = _open_progress_db()
+atexit.register(_PROGRESS_DB.close)
+
+def get_reading_progress(file_hash):
+    """从缓存中读取阅读进度"""
+    try:
+        with _PROGRESS_LOCK:
+            row = _PROGRESS_DB.execute('SELECT position, percentage, ts FROM progress WHERE hash = ?',
+                                       (file_hash,)).fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"无法读取阅读进度: {e}")
+        return None
+    if row is None:
+        return None
+    return {'position': row[0], 'percentage': row[1], 'timestamp': row[2]}
 
 def save_reading_progress(file_hash, progress_data):
     """保存阅读进度到缓存"""
-    import json
-    progress_file = os.path.join(app.config['IMAGE_CACHE_DIR'], 'reading_progress.json')
-    data = {}
-    if os.path.exists(progress_file):
-        try:
-            with open(progress_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except (json.JSONDecodeError, IOError):
-            pass
-    data[file_hash] = {
-        'position': progress_data.get('position'),
-        'percentage': progress_data.get('percentage'),
-        'timestamp': time.time()
-    }
     try:
-        with open(progress_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
-    except IOError:
-        logger.error(f"无法写入进度文件 {progress_file}")
+        with _PROGRESS_LOCK:
+            _PROGRESS_DB.execute('INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?)',
+                                 (file_hash, progress_data.get('position'), progress_data.get('percentage'), time.time()))
+    except sqlite3.Error as e:
+        logger.error(f"无法保存阅读进度: {e}")
+
+def clear_reading_progress(file_hash):
+    """清除阅读进度，返回是否存在该记录"""
+    try:
+        with _PROGRESS_LOCK:
+            cursor = _PROGRESS_DB.execute('DELETE FROM progress WHERE hash = ?', (file_hash,))
+    except sqlite3.Error as e:
+        logger.error(f"无法清除阅读进度: {e}")
+        return False
+    return cursor.rowcount > 0
 
 @app.route("/")
 def index():
@@ -525,35 +819,18 @@ def index():
 def view_file(subpath):
     """查看文件"""
     full = safe_path(app.config["ROOT_DIR"], subpath)
-    if full is None or not os.path.exists(full):
-        abort(404)
+    st = _stat_or_404(full)
     
-    mime, _ = mimetypes.guess_type(full)
+    file_ext = os.path.splitext(full)[1].lower()
+    mime = _mime_for_ext(file_ext)
     filename = os.path.basename(full)
     
-    # 处理图片（图库模式）
-    if mime and mime.startswith("image"):
-        # 获取同目录下所有图片
+    # 处理图片（图库模式，与图片列表使用同一个扩展名集合）
+    if file_ext in _IMAGE_EXTS:
+        # 获取同目录下所有图片（已排序，并带有路径到索引的映射）
         dir_path = os.path.dirname(subpath)
-        entries = list_dir_entries(app.config["ROOT_DIR"], dir_path)
-        
-        image_files = []
-        for entry in entries:
-            if not entry['is_dir']:
-                file_path = safe_path(app.config["ROOT_DIR"], entry['relpath'])
-                file_mime, _ = mimetypes.guess_type(file_path)
-                if file_mime and file_mime.startswith("image"):
-                    image_files.append(entry['relpath'])
-        
-        # 按文件名排序（使用自然排序支持数字）
-        image_files.sort(key=lambda x: natural_sort_key(os.path.basename(x)))
-        
-        # 查找当前图片索引
-        current_index = -1
-        try:
-            current_index = image_files.index(subpath)
-        except ValueError:
-            pass
+        image_files, image_index = list_image_files(app.config["ROOT_DIR"], dir_path)
+        current_index = image_index.get(subpath, -1)
         
         # 计算上一张和下一张
         prev_url = None
@@ -575,11 +852,8 @@ def view_file(subpath):
     # 处理视频/音频
     elif mime and mime.startswith(('video', 'audio')):
         # 检查格式兼容性
-        file_ext = os.path.splitext(full)[1].lower()
-        # 浏览器原生支持的格式（注：AVI虽然有些浏览器支持，但兼容性差，建议转码）
-        natively_supported = ['.mp4', '.webm', '.ogg', '.ogv', '.m4v']
-        # 如果格式不被原生支持，则需要转码
-        needs_transcode = file_ext not in natively_supported
+        # 如果格式不被浏览器原生播放，则需要转码
+        needs_transcode = file_ext not in BROWSER_PLAYABLE_EXTS
         
         # 只有在需要转码或需要显示详细信息时才获取媒体信息（以节省资源）
         media_info = {}
@@ -614,24 +888,42 @@ def view_file(subpath):
         progress = get_reading_progress(file_hash)
         # 读取文件内容（限制大小）
         max_size = 10 * 1024 * 1024  # 10 MB
-        file_size = os.path.getsize(full)
+        file_size = st.st_size
         if file_size > max_size:
             # 文件过大，提供下载
             return redirect(url_for("files_raw", subpath=subpath))
-        # 尝试多种编码读取文本文件
-        encodings = ['utf-8-sig', 'utf-8', 'gbk', 'gb2312', 'big5', 'shift_jis', 'latin-1']
+        # 只读取一次文件，编码检测和解码都在内存中完成
+        with open(full, 'rb') as f:
+            raw = f.read()
         content = None
-        for enc in encodings:
-            try:
-                with open(full, 'r', encoding=enc, errors='strict') as f:
-                    content = f.read()
+        # 大多数文本是 UTF-8，先严格解码整个文件（utf-8-sig 会去掉可能存在的 BOM），失败再检测编码
+        try:
+            content = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            pass
+        if content is None and CHARSET_NORMALIZER_AVAILABLE:
+            # 用前 64 KB 样本判断编码，样本截到最后一个换行，避免多字节字符被截断
+            sample = raw[:65536]
+            sample = sample.rpartition(b'\n')[0] or sample
+            best = charset_normalizer.from_bytes(sample).best()
+            # 整个文件已经不是合法的 UTF-8，样本判断为 ascii/utf_8 时交给下面的逐个尝试
+            if best is not None and best.encoding not in ('utf_8', 'ascii'):
+                try:
+                    content = raw.decode(best.encoding, errors='replace')
+                except LookupError:
+                    pass
+        if content is None:
+            # 尝试多种编码解码文本内容
+            encodings = ['gbk', 'gb2312', 'big5', 'shift_jis', 'latin-1']
+            for enc in encodings:
+                try:
+                    content = raw.decode(enc, errors='strict')
                     break
-            except (UnicodeDecodeError, LookupError):
-                continue
+                except (UnicodeDecodeError, LookupError):
+                    continue
         if content is None:
             # 所有编码尝试失败，使用 errors='replace' 作为最后手段
-            with open(full, 'r', errors='replace') as f:
-                content = f.read()
+            content = raw.decode('utf-8', errors='replace')
         # 渲染文本阅读器模板
         return render_template('text_viewer.html',
                                content=content,
@@ -648,7 +940,6 @@ def view_file(subpath):
 @app.route("/transcode/<path:subpath>")
 def transcode_file(subpath):
     """转码文件流（用于不兼容格式）"""
-    import tempfile
     import subprocess
     
     # 本路由依赖系统上安装的 FFmpeg 来进行转码（支持软/硬件加速）
@@ -656,247 +947,259 @@ def transcode_file(subpath):
         abort(503, description=("系统未检测到 FFmpeg，可执行文件不可用。\n" + FFMPEG_INSTALL_GUIDE))
 
     full = safe_path(app.config["ROOT_DIR"], subpath)
-    if full is None or not os.path.exists(full):
-        abort(404)
+    _stat_or_404(full)
 
     # 如果是图片文件，直接返回原始文件，不转码
-    mime, _ = mimetypes.guess_type(full)
+    mime = _mime_for_ext(os.path.splitext(full)[1].lower())
     if mime and mime.startswith("image"):
         logger.info(f"图片文件请求到转码路由，直接返回原始文件: {subpath}")
         return send_file(full, mimetype=mime)
 
-    # 创建临时MP4文件用于转码输出
-    temp_file = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False)
-    temp_path = temp_file.name
-    temp_file.close()
+    # 检测硬件加速信息（启动时已探测并存入 HW_INFO）
+    hw_info = app.config.get('HW_INFO') or detect_hardware_acceleration()
+    use_hw = app.config['USE_HARDWARE_ACCEL'] and bool(hw_info.get('gpu_encoders'))
 
-    def cleanup_temp():
-        try:
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
-        except:
-            pass
+    # 限制同时运行的转码进程数量，避免多个 FFmpeg 争抢 GPU 编码会话；
+    # 试转码也会占用编码会话，所以在试转码之前就取得名额，之后每个出错分支都要释放
+    if not TRANSCODE_SEM.acquire(timeout=TRANSCODE_QUEUE_TIMEOUT):
+        logger.warning(f"转码任务已满，拒绝请求: {subpath}")
+        abort(503, description="当前转码任务过多，请稍后再试")
 
-    try:
-        # 检测硬件加速信息
-        hw_info = detect_hardware_acceleration()
-        use_hw = app.config['USE_HARDWARE_ACCEL'] and bool(hw_info.get('gpu_encoders'))
-
-        # 首先尝试使用硬件加速，如果失败则回退到软件编码
-        attempts = [
-            ('hardware', use_hw),  # 首次尝试：硬件加速
-            ('software', True)     # 备选方案：软件编码
-        ]
+    # 首先尝试使用硬件加速，如果失败则回退到软件编码
+    attempts = [
+        ('hardware', use_hw),  # 首次尝试：硬件加速
+        ('software', True)     # 备选方案：软件编码
+    ]
 
-        transcode_success = False
-        last_error = None
-
-        for attempt_type, should_attempt in attempts:
-            if not should_attempt:
-                continue
-
-            logger.info(f"尝试转码方案: {attempt_type}")
-
-            # 构建 FFmpeg 命令
-            ffmpeg_path = get_ffmpeg_path()
-            ffmpeg_cmd = [ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error']
-
-            if attempt_type == 'hardware' and use_hw:
-                encoder, hwaccel = hw_info['gpu_encoders'][0]
-                logger.info(f"使用 GPU 加速：编码器={encoder}，硬件加速={hwaccel}")
-                
-                # 检查输入文件是否是JPEG（某些硬件加速对JPEG支持不好）
-                file_ext = os.path.splitext(full)[1].lower()
-                is_jpeg = file_ext in ['.jpg', '.jpeg', '.jpe']
-                
-                # 为不同的硬件加速类型应用不同的参数
-                if hwaccel == 'qsv' and not is_jpeg:
-                    # Intel Quick Sync Video - JPEG支持不稳定，跳过硬件解码
-                    ffmpeg_cmd.extend(['-hwaccel', 'qsv'])
-                elif hwaccel == 'amf':
-                    # AMD Media Framework - 不需要解码硬件加速
-                    pass
-                elif hwaccel == 'cuda' and not is_jpeg:
-                    # NVIDIA CUDA - JPEG也可能有问题
-                    ffmpeg_cmd.extend(['-hwaccel', 'cuda', '-hwaccel_device', str(app.config['GPU_DEVICE'])])
-            else:
-                logger.info("使用软件编码（CPU）")
-
-            # 输入文件
-            ffmpeg_cmd.extend(['-i', full])
-
-            # 视频编码
-            if attempt_type == 'hardware' and use_hw:
-                encoder, hwaccel = hw_info['gpu_encoders'][0]
-                
-                # 为不同的编码器设置合适的参数
-                if encoder == 'h264_qsv':
-                    # Intel QSV 编码器
-                    ffmpeg_cmd.extend(['-c:v', encoder, '-preset', 'veryfast', '-b:v', '2500k', '-pix_fmt', 'yuv420p'])
-                elif encoder == 'h264_amf':
-                    # AMD AMF 编码器
-                    ffmpeg_cmd.extend(['-c:v', encoder, '-quality', 'speed', '-b:v', '2500k', '-pix_fmt', 'yuv420p'])
-                else:  # h264_nvenc
-                    # NVIDIA NVENC 编码器
-                    ffmpeg_cmd.extend(['-c:v', encoder, '-preset', 'fast', '-b:v', '2000k', '-maxrate', '3000k', '-bufsize', '4000k', '-pix_fmt', 'yuv420p'])
-            else:
-                # 软件编码使用超快速设置以加速转码
-                ffmpeg_cmd.extend(['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-pix_fmt', 'yuv420p'])
+    selected_cmd = None
+    last_error = None
 
-            # 音频编码
-            ffmpeg_cmd.extend(['-c:a', 'aac', '-b:a', '128k', '-ac', '2'])
+    for attempt_type, should_attempt in attempts:
+        if not should_attempt:
+            continue
 
-            # 输出为普通MP4文件（带faststart以支持边播边下载）
-            ffmpeg_cmd.extend(['-f', 'mp4', '-movflags', 'faststart', temp_path])
+        logger.info(f"尝试转码方案: {attempt_type}")
 
-            logger.info(f"FFmpeg 命令: {' '.join(ffmpeg_cmd)}")
+        # 构建 FFmpeg 命令
+        ffmpeg_path = get_ffmpeg_path()
+        ffmpeg_cmd = [ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error']
+        # 解码后的帧是否留在显存中（直接送入 GPU 编码器，不经过内存往返）
+        gpu_frames = False
 
-            try:
-                # 执行转码
-                result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=600)
+        if attempt_type == 'hardware' and use_hw:
+            encoder, hwaccel = hw_info['gpu_encoders'][0]
+            logger.info(f"使用 GPU 加速：编码器={encoder}，硬件加速={hwaccel}")
+            
+            # 检查输入文件是否是JPEG（某些硬件加速对JPEG支持不好）
+            file_ext = os.path.splitext(full)[1].lower()
+            is_jpeg = file_ext in _JPEG_EXTS
+            
+            # 为不同的硬件加速类型应用不同的参数
+            if hwaccel == 'qsv' and not is_jpeg:
+                # Intel Quick Sync Video - JPEG支持不稳定，跳过硬件解码
+                ffmpeg_cmd.extend(['-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv'])
+                gpu_frames = True
+            elif hwaccel == 'amf':
+                # AMD Media Framework - 不需要解码硬件加速
+                pass
+            elif hwaccel == 'cuda' and not is_jpeg:
+                # NVIDIA CUDA - JPEG也可能有问题
+                ffmpeg_cmd.extend(['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda',
+                                   '-hwaccel_device', str(app.config['GPU_DEVICE'])])
+                gpu_frames = True
+        else:
+            logger.info("使用软件编码（CPU）")
 
-                if result.returncode == 0 and os.path.exists(temp_path) and os.path.getsize(temp_path) > 1000:
-                    logger.info(f"转码成功（{attempt_type}方案），文件大小: {os.path.getsize(temp_path)} 字节")
-                    transcode_success = True
-                    break
-                else:
-                    err = result.stderr or result.stdout or "未知错误"
-                    last_error = err
-                    logger.warning(f"转码失败（{attempt_type}方案）: {err[:300]}")
-
-            except subprocess.TimeoutExpired:
-                logger.error(f"转码超时（{attempt_type}方案）")
-                last_error = "转码超时"
-            except Exception as e:
-                logger.error(f"转码异常（{attempt_type}方案）: {e}")
-                last_error = str(e)
-
-        # 如果转码失败，返回错误
-        if not transcode_success:
-            cleanup_temp()
-            error_msg = f"无法转码视频: {last_error[:300]}" if last_error else "转码失败"
-            logger.error(error_msg)
-            abort(500, description=error_msg)
-
-        # 发送临时MP4文件
-        file_size = os.path.getsize(temp_path)
-        
-        def generate():
-            try:
-                with open(temp_path, 'rb') as f:
-                    while True:
-                        chunk = f.read(65536)
-                        if not chunk:
-                            break
-                        yield chunk
-            finally:
-                cleanup_temp()
-
-        headers = {
-            'Content-Type': 'video/mp4',
-            'Accept-Ranges': 'bytes',
-            'Cache-Control': 'no-cache'
-        }
-        
-        return Response(generate(), headers=headers, mimetype='video/mp4')
+        # 输入文件
+        ffmpeg_cmd.extend(['-i', full])
 
+        # 视频编码
+        if attempt_type == 'hardware' and use_hw:
+            encoder, hwaccel = hw_info['gpu_encoders'][0]
+            
+            # 为不同的编码器设置合适的参数
+            if encoder == 'h264_qsv':
+                # Intel QSV 编码器
+                ffmpeg_cmd.extend(['-c:v', encoder, '-preset', 'veryfast', '-b:v', '2500k'])
+            elif encoder == 'h264_amf':
+                # AMD AMF 编码器
+                ffmpeg_cmd.extend(['-c:v', encoder, '-quality', 'speed', '-b:v', '2500k'])
+            else:  # h264_nvenc
+                # NVIDIA NVENC 编码器
+                ffmpeg_cmd.extend(['-c:v', encoder, '-preset', 'fast', '-b:v', '2000k', '-maxrate', '3000k', '-bufsize', '4000k'])
+            # 显存中的帧由编码器直接接收；指定 -pix_fmt 会强制把帧下载回内存
+            if not gpu_frames:
+                ffmpeg_cmd.extend(['-pix_fmt', 'yuv420p'])
+        else:
+            # 软件编码使用超快速设置以加速转码
+            ffmpeg_cmd.extend(['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-pix_fmt', 'yuv420p'])
+
+        # 音频编码
+        ffmpeg_cmd.extend(['-c:a', 'aac', '-b:a', '128k', '-ac', '2'])
+
+        # 先试转码 1 秒（输出丢弃），确认该方案可用后再开始正式的流式转码
+        probe_cmd = ffmpeg_cmd + ['-t', '1', '-f', 'null', '-']
+
+        try:
+            result = subprocess.run(probe_cmd, capture_output=True, text=True, timeout=30)
+
+            if result.returncode == 0:
+                logger.info(f"试转码成功，使用{attempt_type}方案")
+                selected_cmd = ffmpeg_cmd
+                break
+            else:
+                err = result.stderr or result.stdout or "未知错误"
+                last_error = err
+                logger.warning(f"试转码失败（{attempt_type}方案）: {err[:300]}")
+
+        except subprocess.TimeoutExpired:
+            logger.error(f"试转码超时（{attempt_type}方案）")
+            last_error = "转码超时"
+        except Exception as e:
+            logger.error(f"试转码异常（{attempt_type}方案）: {e}")
+            last_error = str(e)
+
+    # 如果所有方案都不可用，返回错误
+    if selected_cmd is None:
+        TRANSCODE_SEM.release()
+        error_msg = f"无法转码视频: {last_error[:300]}" if last_error else "转码失败"
+        logger.error(error_msg)
+        abort(500, description=error_msg)
+
+    # 输出分片 MP4 到 stdout（写管道必须使用分片格式），客户端可以边转码边播放
+    selected_cmd.extend(['-f', 'mp4', '-movflags', '+frag_keyframe+empty_moov+default_base_moof', 'pipe:1'])
+    logger.info(f"FFmpeg 命令: {' '.join(selected_cmd)}")
+
+    try:
+        proc = subprocess.Popen(selected_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
     except Exception as e:
-        cleanup_temp()
+        TRANSCODE_SEM.release()
         logger.error(f"转码端点异常: {e}")
         abort(500, description=f"服务器错误: {str(e)}")
 
-def partial_response(path, range_header):
-    """部分响应（支持断点续传）"""
-    full_size = os.path.getsize(path)
-    if not range_header:
-        return None
-    
-    units, _, range_spec = range_header.partition("=")
-    if units != "bytes":
-        return None
-    
-    start_str, _, end_str = range_spec.partition("-")
-    try:
-        start = int(start_str) if start_str else 0
-        end = int(end_str) if end_str else full_size - 1
-    except ValueError:
-        return None
-    
-    if start > end or end >= full_size:
-        return None
-    
-    chunk_size = end - start + 1
-    
     def generate():
-        with open(path, "rb") as f:
-            f.seek(start)
-            remaining = chunk_size
-            while remaining > 0:
-                read_len = min(8192, remaining)
-                data = f.read(read_len)
-                if not data:
-                    break
-                remaining -= len(data)
-                yield data
+        # 管道读取是非阻塞凑满的：有多少数据就返回多少，最多 1 MB
+        read = proc.stdout.read
+        while True:
+            chunk = read(TRANSCODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def cleanup_process():
+        # 传输结束或客户端断开连接时结束 FFmpeg 进程
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        TRANSCODE_SEM.release()
+
+    headers = {
+        'Content-Type': 'video/mp4',
+        'Cache-Control': 'no-cache'
+    }
     
-    mime, _ = mimetypes.guess_type(path)
-    rv = Response(generate(), status=206, mimetype=mime or "application/octet-stream")
-    rv.headers["Content-Range"] = f"bytes {start}-{end}/{full_size}"
-    rv.headers["Accept-Ranges"] = "bytes"
-    rv.headers["Content-Length"] = str(chunk_size)
-    return rv
+    response = Response(generate(), headers=headers, mimetype='video/mp4')
+    response.call_on_close(cleanup_process)
+    return response
 
 @app.route("/files/<path:subpath>")
 def files_raw(subpath):
     """原始文件访问"""
     full = safe_path(app.config["ROOT_DIR"], subpath)
-    if full is None or not os.path.exists(full):
-        abort(404)
+    st = _stat_or_404(full)
     
     # 检查是否需要特殊处理
-    mime, _ = mimetypes.guess_type(full)
     file_ext = os.path.splitext(full)[1].lower()
+    mime = _mime_for_ext(file_ext)
     
-    # 浏览器原生支持的格式
-    natively_supported = ['.mp4', '.webm', '.ogg', '.ogv', '.m4v', '.mpg', '.mpeg', '.avi', '.mov', '.wmv']
     # 如果格式不被原生支持且 DeFFcode 可用，则提供转码选项
-    if file_ext not in natively_supported and DEFFCODE_AVAILABLE:
+    if file_ext not in NATIVELY_SUPPORTED and DEFFCODE_AVAILABLE:
         return redirect(url_for("transcode_file", subpath=subpath))
     
-    range_header = request.headers.get("Range", None)
-    if range_header:
-        part = partial_response(full, range_header)
-        if part:
-            return part
+    # 用 inode/大小/修改时间生成 ETag，客户端缓存未失效时直接返回 304，不打开文件
+    etag, last_modified = _file_validators(st)
+    if _is_not_modified(request.headers, etag, last_modified):
+        return Response(status=304, headers=_not_modified_headers(etag, last_modified))
     
-    return send_file(full, as_attachment=False, conditional=True)
+    # conditional=True 时由 Werkzeug 处理 Range 请求（断点续传/拖动进度）
+    return send_file(full, as_attachment=False, conditional=True,
+                     etag=etag, last_modified=last_modified)
 
 @app.route("/stream/<path:subpath>")
 def stream_file(subpath):
     """流媒体传输"""
     full = safe_path(app.config["ROOT_DIR"], subpath)
-    if full is None or not os.path.exists(full):
-        abort(404)
+    st = _stat_or_404(full)
     
     # 获取正确的MIME类型
-    mime, _ = mimetypes.guess_type(full)
+    mime = _mime_for_ext(os.path.splitext(full)[1].lower())
     if not mime:
         mime = 'application/octet-stream'
     
-    range_header = request.headers.get("Range", None)
-    if range_header:
-        part = partial_response(full, range_header)
-        if part:
-            return part
-    
-    # 设置响应头以支持视频流
-    response = send_file(full, conditional=True, mimetype=mime)
+    # 设置响应头以支持视频流（Range 请求由 Werkzeug 处理）
+    etag, last_modified = _file_validators(st)
+    response = send_file(full, mimetype=mime, conditional=True,
+                         etag=etag, last_modified=last_modified)
     response.headers['Accept-Ranges'] = 'bytes'
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
+# PotPlayer 默认安装路径
+POTPLAYER_PATHS = [
+    "C:\\Program Files\\DAUM\\PotPlayer\\PotPlayerMini64.exe",
+    "C:\\Program Files\\DAUM\\PotPlayer\\PotPlayerMini.exe",
+    "C:\\Program Files (x86)\\DAUM\\PotPlayer\\PotPlayerMini.exe",
+    os.path.expanduser("~\\AppData\\Local\\PotPlayer\\PotPlayerMini64.exe"),
+]
+
+# 未找到 PotPlayer 时最多每隔这么多秒重新查找一次（安装后无需重启即可使用）
+POTPLAYER_RETRY_INTERVAL = 60
+_potplayer_path = None
+_potplayer_checked_at = None
+
+def _probe_potplayer():
+    """查找 PotPlayer 可执行文件（默认安装路径优先，其次是 PATH）"""
+    for path in POTPLAYER_PATHS:
+        if os.path.exists(path):
+            return path
+    return shutil.which('PotPlayerMini64') or shutil.which('PotPlayerMini')
+
+def _find_potplayer():
+    """返回 PotPlayer 路径：找到后一直缓存，未找到的结果缓存 POTPLAYER_RETRY_INTERVAL 秒"""
+    global _potplayer_path, _potplayer_checked_at
+    now = time.monotonic()
+    if _potplayer_path is None and (_potplayer_checked_at is None
+                                    or now - _potplayer_checked_at >= POTPLAYER_RETRY_INTERVAL):
+        _potplayer_path = _probe_potplayer()
+        _potplayer_checked_at = now
+    return _potplayer_path
+
+# PotPlayer 提示页模板（模块加载时生成，back_url 需先做 HTML 转义）
+POTPLAYER_OK_TMPL = """<!doctype html>
+<html>
+<head><meta charset="utf-8"><title>PotPlayer</title></head>
+<body>
+<h3>正在用 PotPlayer 打开文件...</h3>
+<p>如果 PotPlayer 没有自动启动，请手动打开。</p>
+<p><a href="{back_url}">返回播放页面</a></p>
+</body>
+</html>
+"""
+
+POTPLAYER_NOT_FOUND_TMPL = """<!doctype html>
+<html>
+<head><meta charset="utf-8"><title>PotPlayer 未找到</title></head>
+<body>
+<h3>未找到 PotPlayer</h3>
+<p>请确保已安装 PotPlayer，并且安装在默认路径。</p>
+<p><a href="{back_url}">返回播放页面</a></p>
+</body>
+</html>
+"""
+
 @app.route("/potplayer/<path:subpath>")
 def open_potplayer(subpath):
     """用PotPlayer打开文件"""
@@ -904,22 +1207,10 @@ def open_potplayer(subpath):
     import platform
     
     full = safe_path(app.config["ROOT_DIR"], subpath)
-    if full is None or not os.path.exists(full):
-        abort(404)
+    _stat_or_404(full)
     
-    # PotPlayer路径
-    potplayer_paths = [
-        "C:\\Program Files\\DAUM\\PotPlayer\\PotPlayerMini64.exe",
-        "C:\\Program Files\\DAUM\\PotPlayer\\PotPlayerMini.exe",
-        "C:\\Program Files (x86)\\DAUM\\PotPlayer\\PotPlayerMini.exe",
-        os.path.expanduser("~\\AppData\\Local\\PotPlayer\\PotPlayerMini64.exe"),
-    ]
-    
-    potplayer_found = None
-    for path in potplayer_paths:
-        if os.path.exists(path):
-            potplayer_found = path
-            break
+    back_url = escape(url_for("view_file", subpath=subpath))
+    potplayer_found = _find_potplayer()
     
     if potplayer_found:
         try:
@@ -928,58 +1219,73 @@ def open_potplayer(subpath):
                                 shell=False, 
                                 stdout=subprocess.DEVNULL, 
                                 stderr=subprocess.DEVNULL)
-                return '''
-                <!doctype html>
-                <html>
-                <head><meta charset="utf-8"><title>PotPlayer</title></head>
-                <body>
-                <h3>正在用 PotPlayer 打开文件...</h3>
-                <p>如果 PotPlayer 没有自动启动，请手动打开。</p>
-                <p><a href="/view/{}">返回播放页面</a></p>
-                </body>
-                </html>
-                '''.format(subpath)
+                return POTPLAYER_OK_TMPL.format(back_url=back_url)
             else:
                 return "PotPlayer 仅支持 Windows 系统"
         except Exception as e:
-            return f"打开失败: {str(e)}"
+            return f"打开失败: {escape(str(e))}"
     else:
-        return '''
-        <!doctype html>
-        <html>
-        <head><meta charset="utf-8"><title>PotPlayer 未找到</title></head>
-        <body>
-        <h3>未找到 PotPlayer</h3>
-        <p>请确保已安装 PotPlayer，并且安装在默认路径。</p>
-        <p><a href="/view/{}">返回播放页面</a></p>
-        </body>
-        </html>
-        '''.format(subpath)
+        return POTPLAYER_NOT_FOUND_TMPL.format(back_url=back_url)
+
+def _browse_folder_win32(title):
+    """直接调用 shell32.SHBrowseForFolderW 弹出文件夹选择框，取消时返回空字符串"""
+    from ctypes import wintypes
+
+    class BROWSEINFOW(ctypes.Structure):
+        _fields_ = [
+            ("hwndOwner", wintypes.HWND),
+            ("pidlRoot", ctypes.c_void_p),
+            ("pszDisplayName", wintypes.LPWSTR),
+            ("lpszTitle", wintypes.LPCWSTR),
+            ("ulFlags", wintypes.UINT),
+            ("lpfn", ctypes.c_void_p),
+            ("lParam", wintypes.LPARAM),
+            ("iImage", ctypes.c_int),
+        ]
 
-def select_folder_with_windows_api(title="选择文件夹"):
-    """使用 PowerShell 或 tkinter 打开文件夹选择对话框"""
-    import subprocess
-    import sys
+    BIF_RETURNONLYFSDIRS = 0x0001
+    BIF_NEWDIALOGSTYLE = 0x0040
+
+    shell32 = ctypes.windll.shell32
+    ole32 = ctypes.windll.ole32
+    shell32.SHBrowseForFolderW.argtypes = [ctypes.POINTER(BROWSEINFOW)]
+    shell32.SHBrowseForFolderW.restype = ctypes.c_void_p
+    shell32.SHGetPathFromIDListW.argtypes = [ctypes.c_void_p, wintypes.LPWSTR]
+    shell32.SHGetPathFromIDListW.restype = wintypes.BOOL
+    ole32.CoTaskMemFree.argtypes = [ctypes.c_void_p]
 
-    # 尝试 PowerShell
+    # 新样式对话框需要先初始化 COM（单线程套间）
+    ole32.CoInitialize(None)
     try:
-        ps_script = '''
-        Add-Type -AssemblyName System.Windows.Forms
-        $folder = New-Object System.Windows.Forms.FolderBrowserDialog
-        $folder.Description = "%s"
-        $folder.ShowDialog() | Out-Null
-        if ($folder.SelectedPath) {
-            Write-Output $folder.SelectedPath
-        }
-        ''' % title
-        result = subprocess.run(['powershell', '-NoProfile', '-Command', ps_script],
-                                capture_output=True, text=True, timeout=10)
-        if result.returncode == 0 and result.stdout.strip():
-            return result.stdout.strip()
-    except Exception as e:
-        print(f"PowerShell 文件夹选择出错: {e}")
+        display_name = ctypes.create_unicode_buffer(260)
+        info = BROWSEINFOW()
+        info.pszDisplayName = ctypes.cast(display_name, wintypes.LPWSTR)
+        info.lpszTitle = title
+        info.ulFlags = BIF_RETURNONLYFSDIRS | BIF_NEWDIALOGSTYLE
+        pidl = shell32.SHBrowseForFolderW(ctypes.byref(info))
+        if not pidl:
+            return ""
+        try:
+            path = ctypes.create_unicode_buffer(260)
+            if not shell32.SHGetPathFromIDListW(pidl, path):
+                return ""
+            return path.value
+        finally:
+            ole32.CoTaskMemFree(pidl)
+    finally:
+        ole32.CoUninitialize()
+
+def select_folder_with_windows_api(title="选择文件夹"):
+    """使用 Win32 原生对话框或 tkinter 打开文件夹选择对话框"""
+    # 尝试 Windows 原生对话框（无需启动 PowerShell 进程）
+    if os.name == "nt":
+        try:
+            # 原生对话框可用时不再加载 Tk，用户取消即视为未选择
+            return _browse_folder_win32(title) or None
+        except Exception as e:
+            print(f"Windows 文件夹选择出错: {e}")
 
-    # 尝试 tkinter
+    # 原生对话框不可用时才尝试 tkinter
     try:
         import tkinter as tk
         from tkinter import filedialog
@@ -995,84 +1301,289 @@ def select_folder_with_windows_api(title="选择文件夹"):
 
     return None
 
-@app.route("/api/transcode-test")
-def transcode_test():
-    """诊断转码是否能正常工作"""
+# 诊断转码使用的独立线程池，限制同时运行的测试数量
+_TRANSCODE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='transcode-test')
+# 运行中加排队的测试总数上限，反复点击不会堆积 FFmpeg 任务
+_TRANSCODE_TEST_SLOTS = threading.BoundedSemaphore(4)
+
+def _run_transcode_probe():
+    """生成 1 秒测试视频，返回 (响应数据, 状态码)"""
     import subprocess
-    import tempfile
     
     try:
-        # 创建一个简单的测试视频（1秒）
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as tmp:
-            tmp_path = tmp.name
-        
-        # 使用FFmpeg创建一个测试MP4
+        # 使用FFmpeg创建一个测试MP4（1秒），直接输出到管道，只统计字节数，不写临时文件
         ffmpeg_path = get_ffmpeg_path()
+        # 音视频测试源放在同一个 lavfi 滤镜图中，只需一个输入
         cmd = [ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error',
-               '-f', 'lavfi', '-i', 'testsrc=s=320x240:d=1',
-               '-f', 'lavfi', '-i', 'sine=f=440:d=1',
+               '-f', 'lavfi', '-i', 'testsrc=s=320x240:d=1[out0];sine=f=440:d=1[out1]',
+               '-threads', '0',
                '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28', '-pix_fmt', 'yuv420p',
                '-c:a', 'aac', '-b:a', '128k',
-               '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+faststart',
-               tmp_path]
+               '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov',
+               'pipe:1']
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # 超时后结束进程，管道随之关闭，下面的读取循环自然退出
+        timed_out = threading.Event()
+        def kill_on_timeout():
+            timed_out.set()
+            proc.kill()
+        timer = threading.Timer(10, kill_on_timeout)
+        timer.start()
+        try:
+            file_size = 0
+            while chunk := proc.stdout.read(65536):
+                file_size += len(chunk)
+            stderr = proc.stderr.read()
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+            proc.stderr.close()
         
-        if result.returncode == 0:
-            file_size = os.path.getsize(tmp_path)
-            os.unlink(tmp_path)
-            return jsonify({
+        if timed_out.is_set():
+            return {
+                'status': 'error',
+                'message': '测试异常: 转码测试超时'
+            }, 400
+        if returncode == 0:
+            return {
                 'status': 'success',
                 'message': f'转码测试成功，生成了 {file_size} 字节的MP4文件',
                 'file_size': file_size
-            })
+            }, 200
         else:
-            error = result.stderr or result.stdout
-            os.unlink(tmp_path) if os.path.exists(tmp_path) else None
-            return jsonify({
+            error = stderr.decode('utf-8', errors='replace') or f'ffmpeg 退出码 {returncode}'
+            return {
                 'status': 'error',
                 'message': f'转码测试失败: {error[:500]}'
-            }), 400
+            }, 400
     except Exception as e:
-        return jsonify({
+        return {
             'status': 'error',
             'message': f'测试异常: {str(e)}'
-        }), 400
+        }, 400
+
+@app.route("/api/transcode-test")
+def transcode_test():
+    """诊断转码是否能正常工作"""
+    if not _TRANSCODE_TEST_SLOTS.acquire(blocking=False):
+        return ojson({
+            'status': 'error',
+            'message': '转码测试任务过多，请稍后再试'
+        }, 503)
+    future = _TRANSCODE_POOL.submit(_run_transcode_probe)
+    # 任务完成或被取消时归还名额
+    future.add_done_callback(lambda _: _TRANSCODE_TEST_SLOTS.release())
+    try:
+        payload, status = future.result(timeout=11)
+    except FutureTimeoutError:
+        # 仍在排队的任务直接取消，不再启动 FFmpeg
+        future.cancel()
+        return ojson({
+            'status': 'error',
+            'message': '测试异常: 转码测试超时'
+        }, 400)
+    return ojson(payload, status)
 
 @app.route("/api/save-reading-progress", methods=["POST"])
 def api_save_reading_progress():
     """保存阅读进度"""
     data = request.get_json()
     if not data or "hash" not in data:
-        return jsonify({"success": False, "error": "Missing hash"}), 400
+        return ojson({"success": False, "error": "Missing hash"}, 400)
     file_hash = data["hash"]
     progress_data = {
         "position": data.get("position"),
         "percentage": data.get("percentage")
     }
     save_reading_progress(file_hash, progress_data)
-    return jsonify({"success": True})
+    return ojson({"success": True})
 
 @app.route("/api/clear-reading-progress", methods=["POST"])
 def api_clear_reading_progress():
     """清除阅读进度"""
     data = request.get_json()
     if not data or "hash" not in data:
-        return jsonify({"success": False, "error": "Missing hash"}), 400
+        return ojson({"success": False, "error": "Missing hash"}, 400)
     file_hash = data["hash"]
-    progress_file = os.path.join(app.config['IMAGE_CACHE_DIR'], 'reading_progress.json')
-    if os.path.exists(progress_file):
+    if clear_reading_progress(file_hash):
+        return ojson({"success": True})
+    return ojson({"success": False, "error": "Progress not found"})
+
+# ---------------------------------------------------------------------------
+# 可选的 ASGI 前端（--asgi）：/files 与 /stream 使用异步处理器，
+# 大量并发的视频拖动/续传连接不再各自占用一个线程；其余路由仍由 Flask 处理
+# ---------------------------------------------------------------------------
+
+# 异步文件传输时每次读取的字节数
+ASGI_CHUNK_SIZE = 1024 * 1024
+# 提示内核预读的字节数（只预读开头一段，避免开放式 Range 请求把整部影片读进页缓存）
+READAHEAD_SIZE = 8 * 1024 * 1024
+
+def _parse_byte_range(range_header, file_size):
+    """解析单个 Range 请求头，返回 (start, end)；无法满足时返回 None（按完整文件响应）"""
+    if not range_header:
+        return None
+    units, _, range_spec = range_header.partition("=")
+    if units.strip() != "bytes" or "," in range_spec:
+        return None
+    start_str, _, end_str = range_spec.strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+        else:
+            # 后缀范围，例如 "bytes=-500" 表示最后 500 字节
+            start = max(file_size - int(end_str), 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    if start > end or start >= file_size:
+        return None
+    return start, end
+
+def _open_file_range(path, start, length):
+    """打开文件并定位到区间起点，同时提示内核按顺序预读"""
+    f = open(path, 'rb')
+    f.seek(start)
+    if hasattr(os, 'posix_fadvise'):
         try:
-            with open(progress_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            if file_hash in data:
-                del data[file_hash]
-                with open(progress_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2)
-                return jsonify({"success": True})
-        except (json.JSONDecodeError, IOError):
+            fd = f.fileno()
+            os.posix_fadvise(fd, start, length, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, start, min(length, READAHEAD_SIZE), os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+    return f
+
+async def _aiter_file_range(path, start, length):
+    """在线程池中分块读取文件区间，避免阻塞事件循环"""
+    f = await anyio.to_thread.run_sync(_open_file_range, path, start, length)
+    try:
+        remaining = length
+        while remaining > 0:
+            data = await anyio.to_thread.run_sync(f.read, min(ASGI_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        # 客户端断开时流会被取消，屏蔽取消以确保文件一定被关闭
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(f.close)
+
+def _asgi_file_response(request, full, st, mime, headers=None):
+    """构造支持 Range 请求的异步文件响应（st 为已在线程池中取得的 stat 结果）"""
+    file_size = st.st_size
+    etag, last_modified = _file_validators(st)
+    headers = dict(headers or {})
+    headers.update(_not_modified_headers(etag, last_modified))
+    # 与 Flask 路由相同的条件请求处理：客户端缓存仍有效时直接返回 304，不打开文件
+    if _is_not_modified(request.headers, etag, last_modified):
+        return StarletteResponse(status_code=304, headers=headers)
+    headers['Accept-Ranges'] = 'bytes'
+    byte_range = _parse_byte_range(request.headers.get('range'), file_size)
+    # If-Range 与当前验证器不一致时说明文件已变化，返回完整文件
+    if_range = request.headers.get('if-range')
+    if if_range and if_range not in (headers['ETag'], headers['Last-Modified']):
+        byte_range = None
+    if byte_range is None:
+        # 完整文件交给 FileResponse：服务器支持 http.response.pathsend 扩展时由服务器直接发送文件（零拷贝）
+        return FileResponse(full, media_type=mime, headers=headers, stat_result=st)
+    start, end = byte_range
+    length = end - start + 1
+    headers['Content-Range'] = f"bytes {start}-{end}/{file_size}"
+    headers['Content-Length'] = str(length)
+    return StreamingResponse(_aiter_file_range(full, start, length), status_code=206, media_type=mime, headers=headers)
+
+async def asgi_files_raw(request):
+    """原始文件访问（ASGI 版本，与 files_raw 行为一致）"""
+    subpath = request.path_params['subpath']
+    full = safe_path(app.config["ROOT_DIR"], subpath)
+    # stat 可能很慢（网络盘），放到线程池中执行，避免阻塞事件循环
+    st = await anyio.to_thread.run_sync(_stat_regular_file, full) if full else None
+    if st is None:
+        return PlainTextResponse("Not Found", status_code=404)
+    
+    file_ext = os.path.splitext(full)[1].lower()
+    # 如果格式不被原生支持且 DeFFcode 可用，则提供转码选项
+    if file_ext not in NATIVELY_SUPPORTED and DEFFCODE_AVAILABLE:
+        return RedirectResponse("/transcode/" + quote(subpath), status_code=302)
+    
+    mime = _mime_for_ext(file_ext) or 'application/octet-stream'
+    return _asgi_file_response(request, full, st, mime)
+
+async def asgi_stream_file(request):
+    """流媒体传输（ASGI 版本，与 stream_file 行为一致）"""
+    full = safe_path(app.config["ROOT_DIR"], request.path_params['subpath'])
+    st = await anyio.to_thread.run_sync(_stat_regular_file, full) if full else None
+    if st is None:
+        return PlainTextResponse("Not Found", status_code=404)
+    
+    mime = _mime_for_ext(os.path.splitext(full)[1].lower()) or 'application/octet-stream'
+    headers = {
+        'Cache-Control': 'no-cache, no-store, must-revalidate',
+        'Pragma': 'no-cache',
+        'Expires': '0'
+    }
+    return _asgi_file_response(request, full, st, mime, headers)
+
+def create_asgi_app():
+    """创建 ASGI 应用：/files 和 /stream 走异步处理器，其余请求转交 Flask 应用"""
+    return Starlette(routes=[
+        Route("/files/{subpath:path}", asgi_files_raw),
+        Route("/stream/{subpath:path}", asgi_stream_file),
+        Mount("/", app=WSGIMiddleware(app)),
+    ])
+
+# waitress 在工作线程里迭代 Range 视频响应和转码输出，客户端暂停读取时该线程一直被占用，
+# 因此在 --workers 之外为并发视频流额外预留线程（--stream-threads），避免少数暂停的播放器占满线程池
+STREAM_THREADS = 64
+
+# 连接的发送缓冲区加大到 4 MiB，局域网高速传输视频时减少内核与进程之间的往返
+SOCKET_SNDBUF = 4 * 1024 * 1024
+
+def _should_set_sndbuf():
+    """是否显式设置 SO_SNDBUF（只在确实能变大时设置）"""
+    # Windows 默认发送缓冲区较小，始终设置
+    if os.name == "nt":
+        return True
+    # Linux 显式设置会关闭发送缓冲区自动调节，且会被截断到 net.core.wmem_max（默认约 208 KB），
+    # 只有 wmem_max 允许完整的 SOCKET_SNDBUF 时才设置；其他系统保持默认的自动调节
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/sys/net/core/wmem_max") as f:
+                return int(f.read()) >= SOCKET_SNDBUF
+        except (OSError, ValueError):
+            return False
+    return False
+
+SET_SNDBUF = _should_set_sndbuf()
+SOCKET_OPTIONS = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+if SET_SNDBUF:
+    SOCKET_OPTIONS.append((socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF))
+
+class TunedRequestHandler(WSGIRequestHandler):
+    """Flask 内置服务器的请求处理器：为每个连接设置 SOCKET_OPTIONS"""
+
+    def setup(self):
+        super().setup()
+        for level, option, value in SOCKET_OPTIONS:
+            try:
+                self.connection.setsockopt(level, option, value)
+            except OSError:
+                pass
+
+def create_listen_socket(host, port):
+    """创建 waitress 使用的监听套接字（接受的连接会继承发送缓冲区大小，TCP_NODELAY 由 waitress 设置）"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family)
+    if SET_SNDBUF:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF)
+        except OSError:
             pass
-    return jsonify({"success": False, "error": "Progress not found"})
+    return sock
 
 def main():
     """主函数"""
@@ -1080,15 +1591,26 @@ def main():
     parser.add_argument("dir", nargs="?", default=".", help="要共享的目录")
     parser.add_argument("--host", default="0.0.0.0", help="绑定的主机")
     parser.add_argument("--port", type=int, default=2778, help="监听的端口")
-    parser.add_argument("--workers", type=int, default=4, help="工作线程数")
+    parser.add_argument("--workers", type=int, default=4, help="处理普通请求的工作线程数")
+    parser.add_argument("--stream-threads", type=int, default=STREAM_THREADS,
+                        help="waitress 额外为视频流预留的线程数（每个正在播放或暂停的视频占用一个线程）")
     parser.add_argument("--gpu", type=int, default=0, help="GPU设备索引")
     parser.add_argument("--no-hwaccel", action="store_true", help="禁用硬件加速")
     parser.add_argument("--cache-size", type=int, default=256, help="目录缓存大小")
+    parser.add_argument("--max-transcodes", type=int, default=2, help="同时转码的最大数量")
+    parser.add_argument("--asgi", action="store_true", help="使用 ASGI (uvicorn) 服务器，异步处理文件流")
+    parser.add_argument("--dev", action="store_true", help="使用 Flask 内置开发服务器（调试用）")
     
     args = parser.parse_args()
 
+    # 硬件加速检测（ffmpeg 子进程探测）在后台进行
+    startup_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup')
+    hw_future = None
+
     # 如果未指定目录（使用默认值），尝试通过Windows API选择文件夹
     if args.dir == ".":
+        # 需要弹出对话框时提前开始检测，与用户选择目录同时进行
+        hw_future = startup_pool.submit(detect_hardware_acceleration)
         try:
             selected = select_folder_with_windows_api("请选择要共享的目录")
             if selected:
@@ -1105,18 +1627,30 @@ def main():
     root = os.path.abspath(args.dir)
     if not os.path.isdir(root):
         print("错误: 不是目录:", root)
+        # 取消尚未开始的后台任务，不再等待检测结果
+        startup_pool.shutdown(wait=False, cancel_futures=True)
         return
     
+    if hw_future is None:
+        hw_future = startup_pool.submit(detect_hardware_acceleration)
+    
     app.config["ROOT_DIR"] = root
     print(f"服务根目录已设置为: {root}")
     app.config["USE_HARDWARE_ACCEL"] = not args.no_hwaccel
     app.config["GPU_DEVICE"] = args.gpu
+    app.config["MAX_CONCURRENT_TRANSCODES"] = max(1, args.max_transcodes)
+
+    # 按命令行参数重建转码并发限制
+    global TRANSCODE_SEM
+    TRANSCODE_SEM = threading.BoundedSemaphore(app.config["MAX_CONCURRENT_TRANSCODES"])
     
-    # 更新缓存大小
-    global list_dir_entries_cached, get_directory_cache_key
-    if args.cache_size != 256:
-        list_dir_entries_cached = lru_cache(maxsize=args.cache_size)(_list_dir_entries_cached_raw)
-        get_directory_cache_key = lru_cache(maxsize=args.cache_size)(_get_directory_cache_key_raw)
+    # 按命令行参数设置目录缓存键的容量
+    global _DIR_KEY_CACHE
+    _DIR_KEY_CACHE = TTLCache(maxsize=max(1, args.cache_size), ttl=DIR_KEY_TTL)
+    
+    # 后台预热根目录列表缓存，首页首次打开无需等待扫描
+    startup_pool.submit(list_dir_entries, root, "")
+    startup_pool.shutdown(wait=False)
     
     print("=" * 60)
     print(f"WebCinema 高性能媒体服务器")
@@ -1125,7 +1659,8 @@ def main():
     print(f"访问地址: http://{args.host}:{args.port}")
     print(f"硬件加速: {'已启用' if app.config['USE_HARDWARE_ACCEL'] else '已禁用'}")
     # 检测硬件加速
-    hw_info = detect_hardware_acceleration()
+    hw_info = hw_future.result()
+    app.config['HW_INFO'] = hw_info
     
     gpu_type_display = {
         'intel': 'Intel (QSV)',
@@ -1147,15 +1682,42 @@ def main():
     else:
         print(f"⚠ DeFFcode: 未安装，使用系统 FFmpeg 进行转码")
     print(f"目录缓存: {args.cache_size}")
-    print(f"工作线程: {args.workers}")
+    workers = max(1, args.workers)
+    stream_threads = max(0, args.stream_threads)
+    use_waitress = WAITRESS_AVAILABLE and not args.dev and not (args.asgi and ASGI_AVAILABLE)
+    if use_waitress:
+        print(f"工作线程: {workers + stream_threads}（普通请求 {workers} + 视频流预留 {stream_threads}）")
+    else:
+        print(f"工作线程: {workers}")
+    print(f"并发转码: {app.config['MAX_CONCURRENT_TRANSCODES']}")
     print("=" * 60)
     
     # 启动服务器
+    if args.asgi:
+        if ASGI_AVAILABLE:
+            # 单进程事件循环即可处理大量并发连接（多进程无法共享启动时的配置）
+            uvicorn.run(create_asgi_app(), host=args.host, port=args.port, loop="auto", log_level="info")
+            return
+        print("⚠ 未安装 starlette/uvicorn/a2wsgi，回退到 WSGI 服务器")
+    if use_waitress:
+        # 有上限的线程池 + keep-alive 连接复用；视频流会长时间占用线程，所以额外预留 --stream-threads
+        waitress.serve(
+            app,
+            sockets=[create_listen_socket(args.host, args.port)],
+            threads=workers + stream_threads,
+            connection_limit=1000,
+            channel_timeout=60,
+            asyncore_use_poll=(os.name != "nt"),
+        )
+        return
+    if not args.dev:
+        print("⚠ 未安装 waitress，使用 Flask 内置服务器")
     app.run(
         host=args.host, 
         port=args.port, 
         threaded=True,
-        debug=False
+        debug=False,
+        request_handler=TunedRequestHandler
     )
 
 if __name__ == "__main__":
@@ -7,6 +7,8 @@ WebCinema 启动器 - 最终稳定版
 
 import os
 import sys
+import json
+import shutil
 import subprocess
 import threading
 import time
@@ -40,8 +42,38 @@ def find_webcinema_path(launcher_dir):
     
     return None
 
+def get_cache_file():
+    """启动器缓存文件路径（%LOCALAPPDATA%/webcinema/launcher.json）"""
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'webcinema', 'launcher.json')
+
+def load_cached_python():
+    """读取上次找到的 Python 路径，文件仍存在才使用"""
+    try:
+        with open(get_cache_file(), 'r', encoding='utf-8') as f:
+            path = json.load(f).get('python')
+        if path and os.path.exists(path):
+            return path
+    except:
+        pass
+    return None
+
+def save_cached_python(path):
+    """保存找到的 Python 路径，失败时忽略"""
+    try:
+        cache_file = get_cache_file()
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump({'python': path}, f)
+    except:
+        pass
+
 def find_python_executable():
-    """查找可用的 Python 解释器"""
+    """查找可用的 Python 解释器（优先使用缓存的路径）"""
+    cached = load_cached_python()
+    if cached:
+        return cached
+    
     candidates = ['python', 'python3', 'py']
     for cmd in candidates:
         try:
@@ -49,7 +81,11 @@ def find_python_executable():
             result = subprocess.run([cmd, '--version'], 
                                   capture_output=True, text=True, timeout=2)
             if result.returncode == 0:
-                return cmd
+                # 缓存完整路径，下次启动只需检查文件是否存在
+                full_path = shutil.which(cmd)
+                if full_path:
+                    save_cached_python(full_path)
+                return full_path or cmd
         except:
             continue
     # 备用：当前解释器
@@ -99,18 +135,28 @@ def run():
             cwd=webcinema_dir,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            encoding=locale.getpreferredencoding(),
-            errors='replace',
-            bufsize=1
+            bufsize=0
         )
         
-        # 输出重定向线程
+        # 输出重定向线程：按块读取原始管道，再按行拆分解码
         def output_reader(proc):
-            for line in iter(proc.stdout.readline, ''):
-                if line.strip():
-                    # 可在此处过滤或格式化 Flask 输出
-                    print(f"> {line.rstrip()}")
+            encoding = locale.getpreferredencoding()
+            fd = proc.stdout.fileno()
+            pending = b''
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                *lines, pending = (pending + chunk).split(b'\n')
+                for raw in lines:
+                    line = raw.decode(encoding, errors='replace')
+                    if line.strip():
+                        # 可在此处过滤或格式化 Flask 输出
+                        print(f"> {line.rstrip()}")
+            # 进程结束时输出最后一行不完整的内容
+            line = pending.decode(encoding, errors='replace')
+            if line.strip():
+                print(f"> {line.rstrip()}")
         
         reader_thread = threading.Thread(target=output_reader, args=(process,))
         reader_thread.daemon = True